@@ -4,31 +4,66 @@
 fetch_arxiv.py（最终版 - 保留最近N天新增）
 - 使用 arXiv Atom API 拉取符合 QUERIES 的论文
 - 解析并产出条目格式： id, title, date(YYYY-MM-DD), tags, authors, institution, link, abstract, fetched_at
-- 保留最近 DAYS_TO_KEEP 天（UTC）发布的条目作为新增，合并入已有 history（data/papers.json）
-- 合并去重后按 date/fetched_at 降序保存（保留最近 KEEP_MAX 条）
+- 保留最近 DAYS_TO_KEEP 天（UTC）发布的条目作为新增，只把新条目或内容有变化的条目追加到 history（data/papers.jsonl）
+- history 超过 COMPACT_THRESHOLD 行时压缩重写为最近 KEEP_MAX 条
+- 合并去重后按 date/fetched_at 降序发布到 data/papers.json（保留最近 KEEP_MAX 条）
 """
 from __future__ import annotations
 import os
+import heapq
+import contextlib
 import sys
 import time
 import json
+try:
+    import orjson  # Rust 实现，papers.json 编解码更快
+except ImportError:  # 未安装 orjson 时回退到标准库 json
+    orjson = None
 import requests
-import xml.etree.ElementTree as ET
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+try:
+    from lxml import etree as ET  # libxml2 实现，解析更快
+    HAS_LXML = True
+except ImportError:  # 未安装 lxml 时回退到标准库
+    import xml.etree.ElementTree as ET
+    HAS_LXML = False
+try:
+    import ahocorasick  # pyahocorasick：一次扫描匹配全部机构名
+except ImportError:  # 未安装时回退到逐个子串查找
+    ahocorasick = None
 from datetime import datetime, timedelta, timezone
-from typing import List, Dict, Any
+from typing import IO, Iterator, List, Dict, Any, Optional, Tuple
 
 # ----------------- 配置 -----------------
 ARXIV_API = "http://export.arxiv.org/api/query"
 ROOT = os.path.join(os.path.dirname(__file__), "..")
 DATA_DIR = os.path.join(ROOT, "data")
 OUTPUT_FILE = os.path.join(DATA_DIR, "papers.json")
+HISTORY_FILE = os.path.join(DATA_DIR, "papers.jsonl")  # 追加写的历史记录，每行一个条目
+CACHE_FILE = os.path.join(DATA_DIR, ".arxiv_cache.json")  # 各请求上次响应的 ETag / Last-Modified
 MAX_RESULTS_PER_QUERY = 200
 KEEP_MAX = 600
+COMPACT_THRESHOLD = 2 * KEEP_MAX  # history 行数超过该值时压缩
 DAYS_TO_KEEP = 7  # 保留最近N天的文章（而不是只保留昨日）
+REQUEST_INTERVAL = 3.0  # 相邻两次 arXiv 请求的间隔（秒），arXiv API 要求单连接、请求间隔约 3 秒
+IO_BUFFER_SIZE = 1 << 20  # 读写 papers.json 时的缓冲区大小（1 MiB）
 
 # 请把 email 改为你的联系邮箱（遵守 arXiv 建议）
 HEADERS = {"User-Agent": "llm-agent-feed/1.0 (mailto:your-email@example.com)"}
 
+# 复用同一个 Session：保持长连接、声明 gzip，并由 urllib3 负责失败重试
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+SESSION.headers['Accept-Encoding'] = 'gzip, deflate'
+_ADAPTER = HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=4,
+    max_retries=Retry(total=3, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504]),
+)
+SESSION.mount("http://", _ADAPTER)
+SESSION.mount("https://", _ADAPTER)
+
 # 查询（已修正优先级和括号）
 QUERIES = [
     '(all:"large language model" OR all:"LLM" OR all:"language model") AND all:agent',
@@ -37,8 +72,46 @@ QUERIES = [
     'cat:cs.AI OR cat:cs.CL OR cat:cs.LG'
     ]
 
+# 实际发出的请求：(查询, max_results)。前三条都是 agent + LLM 的组合，结果高度重叠，
+# 合并成一个 OR 查询由服务端取并集；宽泛的 cs.* 分类查询结果量大，单独发出
+BATCHED_QUERIES = [
+    (' OR '.join(f'({q})' for q in QUERIES[:3]), 3 * MAX_RESULTS_PER_QUERY),
+    (QUERIES[3], MAX_RESULTS_PER_QUERY),
+]
+
+# 没有 affiliation 时，在标题+摘要中查找的机构名（按此顺序输出）
+MAX_FALLBACK_ORGS = 3  # 回退匹配最多给出的机构数
+FALLBACK_ORGS = ['Google', 'DeepMind', 'Microsoft', 'Meta', 'OpenAI', 'CMU', 'MIT', 'Stanford', 'Huawei', 'HiSilicon', 'ETH Zurich', 'EPFL']
+
+if ahocorasick is not None:
+    _ORG_AUTOMATON = ahocorasick.Automaton()
+    for _i, _org in enumerate(FALLBACK_ORGS):
+        _ORG_AUTOMATON.add_word(_org.lower(), _i)
+    _ORG_AUTOMATON.make_automaton()
+else:
+    _ORG_AUTOMATON = None
+
+# 预先展开的 QName，find/findall 直接做字符串比较，省去前缀解析
+_A = 'http://www.w3.org/2005/Atom'
+_X = 'http://arxiv.org/schemas/atom'
+TAG_ENTRY = f'{{{_A}}}entry'
+TAG_ID = f'{{{_A}}}id'
+TAG_TITLE = f'{{{_A}}}title'
+TAG_SUMMARY = f'{{{_A}}}summary'
+TAG_PUBLISHED = f'{{{_A}}}published'
+TAG_AUTHOR = f'{{{_A}}}author'
+TAG_NAME = f'{{{_A}}}name'
+TAG_CATEGORY = f'{{{_A}}}category'
+TAG_LINK = f'{{{_A}}}link'
+TAG_AFFILIATION = f'{{{_X}}}affiliation'
+
 # ----------------- 辅助函数 -----------------
-def arxiv_query(search_query: str, start=0, max_results=50) -> str:
+def arxiv_query(search_query: str, start=0, max_results=50,
+                validators: Optional[Dict[str, str]] = None) -> Tuple[Optional[requests.Response], Dict[str, str]]:
+    """返回 (流式响应, 新的缓存校验头)；resp.raw 已处理 gzip 等编码，供 parse_atom 流式解析，调用方负责关闭 resp
+
+    validators 为上次响应的 ETag / Last-Modified，用于条件请求；服务端返回 304 时响应为 None
+    """
     params = {
         "search_query": search_query,
         "start": start,
@@ -46,185 +119,309 @@ def arxiv_query(search_query: str, start=0, max_results=50) -> str:
         "sortBy": "submittedDate",
         "sortOrder": "descending"
     }
-    resp = requests.get(ARXIV_API, params=params, headers=HEADERS, timeout=30)
-    resp.raise_for_status()
-    return resp.text
+    headers = {}
+    if validators:
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+    resp = SESSION.get(ARXIV_API, params=params, headers=headers, timeout=30, stream=True)
+    if resp.status_code == 304:
+        resp.close()
+        return None, validators or {}
+    try:
+        resp.raise_for_status()
+    except requests.HTTPError:
+        resp.close()
+        raise
+    new_validators = {}
+    if resp.headers.get('ETag'):
+        new_validators['etag'] = resp.headers['ETag']
+    if resp.headers.get('Last-Modified'):
+        new_validators['last_modified'] = resp.headers['Last-Modified']
+    resp.raw.decode_content = True
+    return resp, new_validators
 
 def safe_text(elem):
     return (elem.text or "").strip() if elem is not None else ""
 
-def parse_atom(atom_xml: str) -> List[Dict[str, Any]]:
-    ns = {'atom': 'http://www.w3.org/2005/Atom', 'arxiv': 'http://arxiv.org/schemas/atom'}
-    root = ET.fromstring(atom_xml)
-    entries: List[Dict[str, Any]] = []
-    for entry in root.findall('atom:entry', ns):
-        try:
-            raw_id = safe_text(entry.find('atom:id', ns))
-            arxiv_id = raw_id.rsplit('/', 1)[-1] if raw_id else None
-            title = safe_text(entry.find('atom:title', ns)).replace('\n', ' ').strip()
-            summary = safe_text(entry.find('atom:summary', ns)).replace('\n', ' ').strip()
-            published = safe_text(entry.find('atom:published', ns))  # e.g. 2025-10-27T12:34:56Z
-
-            # parse authors + affiliations (if present)
-            authors = []
-            affiliations = set()
-            for author in entry.findall('atom:author', ns):
-                name = safe_text(author.find('atom:name', ns))
-                if name:
-                    authors.append(name)
-                aff = author.find('arxiv:affiliation', ns)
-                if aff is not None and aff.text and aff.text.strip():
-                    affiliations.add(aff.text.strip())
-
-            # categories -> tags
-            cats = [c.attrib.get('term') for c in entry.findall('atom:category', ns) if c.attrib.get('term')]
-
-            # try to find pdf link
-            pdf_link = None
-            for link in entry.findall('atom:link', ns):
-                t = link.attrib.get('type', '')
-                href = link.attrib.get('href', '')
-                if t == 'application/pdf' and href:
-                    pdf_link = href
+def clean_text(elem) -> str:
+    # collapse every whitespace run (newlines, tabs, doubled spaces) to one space in a single pass
+    return " ".join(elem.text.split()) if elem is not None and elem.text else ""
+
+def match_fallback_orgs(text: str) -> List[str]:
+    """返回 text（已小写）中出现的 FALLBACK_ORGS，顺序与 FALLBACK_ORGS 一致，最多 MAX_FALLBACK_ORGS 个"""
+    if _ORG_AUTOMATON is None:
+        found = []
+        for org in FALLBACK_ORGS:
+            if org.lower() in text:
+                found.append(org)
+                if len(found) >= MAX_FALLBACK_ORGS:
                     break
-            if not pdf_link and arxiv_id:
-                pdf_link = f"https://arxiv.org/pdf/{arxiv_id}"
-
-            # build institution (from affiliations if present; otherwise simple fallback)
-            institution = ", ".join(sorted(affiliations)) if affiliations else ""
-            if not institution:
-                fallback_orgs = ['Google', 'DeepMind', 'Microsoft', 'Meta', 'OpenAI', 'CMU', 'MIT', 'Stanford', 'Huawei', 'HiSilicon', 'ETH Zurich', 'EPFL']
-                found = []
-                st = (title + " " + summary).lower()
-                for org in fallback_orgs:
-                    if org.lower() in st:
-                        found.append(org)
-                institution = ", ".join(found)
-
-            # tags: include categories and their suffix
-            tags: List[str] = []
-            for c in cats:
-                if c:
-                    tags.append(c)
-                    if '.' in c:
-                        tags.append(c.split('.')[-1])
-
-            # dedupe tags preserving order
-            seen = set()
-            tags_clean = []
-            for t in tags:
-                tt = t.strip()
-                if tt and tt not in seen:
-                    seen.add(tt)
-                    tags_clean.append(tt)
-
-            # date as YYYY-MM-DD (from published)
-            date = ""
-            if published:
-                try:
-                    date = datetime.fromisoformat(published.replace('Z', '+00:00')).date().isoformat()
-                except Exception:
-                    date = published.split('T')[0] if 'T' in published else published
-
-            entry_obj = {
-                "id": arxiv_id,
-                "title": title,
-                "date": date,
-                "tags": tags_clean,
-                "authors": authors,
-                "institution": institution,
-                "link": pdf_link,
-                "abstract": summary,
-                "fetched_at": datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z')
-            }
-            entries.append(entry_obj)
-        except Exception as e:
-            print("parse entry error:", e, file=sys.stderr)
+        return found
+    hits = {i for _, i in _ORG_AUTOMATON.iter(text)}
+    return [FALLBACK_ORGS[i] for i in sorted(hits)[:MAX_FALLBACK_ORGS]]
+
+def iter_entries(stream: IO[bytes]) -> Iterator[Any]:
+    """逐条产出 <entry> 元素；处理完后立即释放，内存占用与 feed 大小无关"""
+    if HAS_LXML:
+        context = ET.iterparse(stream, events=('end',), tag=TAG_ENTRY,
+                               remove_blank_text=True, huge_tree=False)
+        for _, elem in context:
+            yield elem
+            elem.clear()
+            # 同时删掉已处理的兄弟节点，避免根节点上残留空壳
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+        return
+
+    # 标准库没有 getprevious/getparent：记下根节点，每条处理完后整体清空根节点的子元素
+    context = iter(ET.iterparse(stream, events=('start', 'end')))
+    _, root = next(context)
+    for event, elem in context:
+        if event == 'end' and elem.tag == TAG_ENTRY:
+            yield elem
+            root.clear()
+
+def parse_atom(stream: IO[bytes], fetched_at: str) -> Iterator[Dict[str, Any]]:
+    for entry in iter_entries(stream):
+        # entries without an id cannot be deduped or linked; skip them
+        raw_id = safe_text(entry.find(TAG_ID))
+        if not raw_id:
+            continue
+        arxiv_id = raw_id.rsplit('/', 1)[-1]
+        title = clean_text(entry.find(TAG_TITLE))
+        summary = clean_text(entry.find(TAG_SUMMARY))
+        published = safe_text(entry.find(TAG_PUBLISHED))  # e.g. 2025-10-27T12:34:56Z
+
+        # parse authors + affiliations (if present)
+        authors = []
+        affiliations = set()
+        for author in entry.findall(TAG_AUTHOR):
+            name = safe_text(author.find(TAG_NAME))
+            if name:
+                authors.append(name)
+            aff = author.find(TAG_AFFILIATION)
+            if aff is not None and aff.text and aff.text.strip():
+                affiliations.add(aff.text.strip())
+
+        # categories -> tags
+        cats = [c.attrib.get('term') for c in entry.findall(TAG_CATEGORY) if c.attrib.get('term')]
+
+        # try to find pdf link
+        pdf_link = None
+        for link in entry.findall(TAG_LINK):
+            t = link.attrib.get('type', '')
+            href = link.attrib.get('href', '')
+            if t == 'application/pdf' and href:
+                pdf_link = href
+                break
+        if not pdf_link:
+            pdf_link = f"https://arxiv.org/pdf/{arxiv_id}"
+
+        # build institution (from affiliations if present; otherwise simple fallback)
+        if affiliations:
+            institution = ", ".join(sorted(affiliations))
+        else:
+            st = (title + " " + summary).lower()
+            institution = ", ".join(match_fallback_orgs(st))
+
+        # tags: include categories and their suffix
+        # (interned: the same few category strings repeat across every entry of a run)
+        tags: List[str] = []
+        for c in cats:
+            if c:
+                tags.append(sys.intern(c))
+                if '.' in c:
+                    tags.append(sys.intern(c.split('.')[-1]))
+
+        # dedupe tags preserving order
+        seen = set()
+        tags_clean = []
+        for t in tags:
+            tt = t.strip()
+            if tt and tt not in seen:
+                seen.add(tt)
+                tags_clean.append(tt)
+
+        # date as YYYY-MM-DD (published is ISO 8601 UTC, so the date is its prefix)
+        date = published[:10]
+
+        entry_obj = {
+            "id": arxiv_id,
+            "title": title,
+            "date": date,
+            "tags": tags_clean,
+            "authors": authors,
+            "institution": institution,
+            "link": pdf_link,
+            "abstract": summary,
+            "fetched_at": fetched_at
+        }
+        yield entry_obj
+
+def load_history() -> List[Dict[str, Any]]:
+    loads = orjson.loads if orjson is not None else json.loads
+    entries: List[Dict[str, Any]] = []
+    with open(HISTORY_FILE, 'rb', buffering=IO_BUFFER_SIZE) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                entries.append(loads(line))
+            except ValueError:
+                # 追加过程中崩溃留下的半行，跳过即可
+                continue
     return entries
 
 def load_existing() -> List[Dict[str, Any]]:
+    if os.path.exists(HISTORY_FILE):
+        return load_history()
+    # 尚无 papers.jsonl 时从已发布的 papers.json 迁移
     if not os.path.exists(OUTPUT_FILE):
         return []
     try:
+        if orjson is not None:
+            with open(OUTPUT_FILE, 'rb') as f:
+                return orjson.loads(f.read())
         with open(OUTPUT_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
+            return json.loads(f.read())
     except Exception:
         return []
 
-def save_entries(entries: List[Dict[str, Any]]):
+def _dumps_line(entry: Dict[str, Any]) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(entry) + b'\n'
+    return json.dumps(entry, ensure_ascii=False).encode('utf-8') + b'\n'
+
+def _atomic_write(path: str, payload: bytes):
+    # 先写临时文件再原子替换，写到一半崩溃也不会损坏已有文件
     os.makedirs(DATA_DIR, exist_ok=True)
-    with open(OUTPUT_FILE, 'w', encoding='utf-8') as f:
-        json.dump(entries, f, ensure_ascii=False, indent=2)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb', buffering=IO_BUFFER_SIZE) as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def append_history(entries: List[Dict[str, Any]]):
+    os.makedirs(DATA_DIR, exist_ok=True)
+    with open(HISTORY_FILE, 'a+b', buffering=IO_BUFFER_SIZE) as f:
+        # 上次追加若中途崩溃，末尾可能缺换行；先补上，避免新条目接在半行后面
+        if f.seek(0, os.SEEK_END) > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                f.write(b'\n')
+        f.writelines(_dumps_line(e) for e in entries)
+
+def compact_history(entries: List[Dict[str, Any]]):
+    _atomic_write(HISTORY_FILE, b''.join(_dumps_line(e) for e in entries))
+
+def save_entries(entries: List[Dict[str, Any]]):
+    # 先在内存中序列化完整内容，再一次性写入，避免大量小块 write
+    if orjson is not None:
+        # OPT_INDENT_2 与 json.dump(ensure_ascii=False, indent=2) 输出逐字节一致
+        payload = orjson.dumps(entries, option=orjson.OPT_INDENT_2)
+    else:
+        payload = json.dumps(entries, ensure_ascii=False, indent=2).encode('utf-8')
+    _atomic_write(OUTPUT_FILE, payload)
+
+def load_cache() -> Dict[str, Dict[str, str]]:
+    if not os.path.exists(CACHE_FILE):
+        return {}
+    try:
+        with open(CACHE_FILE, 'r', encoding='utf-8') as f:
+            return json.loads(f.read())
+    except Exception:
+        return {}
+
+def save_cache(cache: Dict[str, Dict[str, str]]):
+    _atomic_write(CACHE_FILE, json.dumps(cache, ensure_ascii=False, indent=2, sort_keys=True).encode('utf-8'))
+
+def content_changed(old: Optional[Dict[str, Any]], new: Dict[str, Any]) -> bool:
+    # fetched_at 每次运行都不同，不算内容变化
+    if old is None:
+        return True
+    return any(old.get(k) != v for k, v in new.items() if k != 'fetched_at')
+
+def cache_key(search_query: str, max_results: int) -> str:
+    return f"{max_results}|{search_query}"
 
 def merge_and_dedupe(old: List[Dict[str, Any]], new: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-    # by id, prefer newer fetched_at from new entries
+    # by id; entries in new were fetched this run, so they always supersede old ones
     by_id: Dict[str, Dict[str, Any]] = {e['id']: e for e in old if e.get('id')}
-    for e in new:
-        if not e.get('id'):
-            continue
-        if e['id'] in by_id:
-            # if new is newer, replace
-            try:
-                if e.get('fetched_at', '') > by_id[e['id']].get('fetched_at', ''): 
-                    by_id[e['id']] = e
-            except Exception:
-                by_id[e['id']] = e
-        else:
-            by_id[e['id']] = e
-    merged = list(by_id.values())
-    # sort by date desc then fetched_at desc
-    def sort_key(x: Dict[str, Any]):
-        return (x.get('date', ''), x.get('fetched_at', ''))
-    merged.sort(key=sort_key, reverse=True)
-    return merged[:KEEP_MAX]
+    by_id.update({e['id']: e for e in new if e.get('id')})
+    # top KEEP_MAX by date desc then fetched_at desc (same order as sorted(..., reverse=True)[:KEEP_MAX])
+    return heapq.nlargest(KEEP_MAX, by_id.values(), key=lambda x: (x.get('date', ''), x.get('fetched_at', '')))
 
 # ----------------- 主流程 -----------------
-def main():
-    all_new = []
-    for q in QUERIES:
-        try:
-            xml = arxiv_query(q, start=0, max_results=MAX_RESULTS_PER_QUERY)
-            ents = parse_atom(xml)
-            all_new.extend(ents)
-            time.sleep(1.0)
-        except Exception as e:
-            print("query error:", e, file=sys.stderr)
+def fetch_query(q: str, fetched_at: str, max_results: int = MAX_RESULTS_PER_QUERY,
+                validators: Optional[Dict[str, str]] = None) -> Tuple[List[Dict[str, Any]], Dict[str, str]]:
+    resp, new_validators = arxiv_query(q, start=0, max_results=max_results, validators=validators)
+    if resp is None:
+        # 304 Not Modified：上次抓到的结果已在 history 中，无需下载和解析
+        return [], new_validators
+    # 解析中途出错时也要关闭连接，否则它既不会归还连接池也不会被关闭
+    with contextlib.closing(resp):
+        return list(parse_atom(resp.raw, fetched_at)), new_validators
 
-    # dedupe within this run by id (keep first seen)
-    uniq: Dict[str, Dict[str, Any]] = {}
-    for e in all_new:
-        if e.get('id') and e['id'] not in uniq:
-            uniq[e['id']] = e
-    new_list = list(uniq.values())
+def main():
+    # 本次运行的所有条目共用同一个 fetched_at（秒级精度）
+    now_utc = datetime.now(timezone.utc)
+    fetched_at = now_utc.strftime('%Y-%m-%dT%H:%M:%SZ')
 
     # calculate cutoff date (UTC): keep articles from the last N days
-    today_utc = datetime.now(timezone.utc).date()
+    today_utc = now_utc.date()
     cutoff_date = today_utc - timedelta(days=DAYS_TO_KEEP)
+    # 在服务端按提交日期过滤，只下载/解析窗口内的条目
+    date_clause = f' AND submittedDate:[{cutoff_date:%Y%m%d}0000 TO {today_utc:%Y%m%d}2359]'
 
-    # filter new_list to keep those published within the last N days
-    new_list_filtered: List[Dict[str, Any]] = []
-    for e in new_list:
-        pub_str = e.get("date", "")
-        if not pub_str:
-            continue
+    # 条件请求的校验头按实际发出的 search_query + max_results 缓存（日期条件每天不同，只有同日重跑能命中）；
+    # history 不存在时校验头保护的数据已丢失，忽略缓存以完整重抓
+    cache = load_cache() if os.path.exists(HISTORY_FILE) else {}
+    requests_this_run = [(f'({q}){date_clause}', n) for q, n in BATCHED_QUERIES]
+
+    # dedupe within this run by id (keep first seen) while collecting results
+    uniq: Dict[str, Dict[str, Any]] = {}
+    # 按 arXiv API 使用条款逐个发出请求（同一时间只有一个连接），请求之间间隔 REQUEST_INTERVAL
+    for i, (q, n) in enumerate(requests_this_run):
+        if i:
+            time.sleep(REQUEST_INTERVAL)
+        key = cache_key(q, n)
         try:
-            pub_date = datetime.fromisoformat(pub_str).date()
-        except Exception:
-            # fallback try fetched_at
-            try:
-                pub_date = datetime.fromisoformat(e.get("fetched_at", "").replace('Z', '+00:00')).date()
-            except Exception:
-                continue
-        # Keep articles published within the last N days (inclusive)
-        if pub_date >= cutoff_date:
-            new_list_filtered.append(e)
+            ents, validators = fetch_query(q, fetched_at, n, cache.get(key))
+        except Exception as e:
+            print("query error:", e, file=sys.stderr)
+            continue
+        if validators:
+            cache[key] = validators
+        for e in ents:
+            eid = e.get('id')
+            if eid and eid not in uniq:
+                uniq[eid] = e
+    new_list = list(uniq.values())
 
+    # filter new_list to keep those published within the last N days (sanity check; server already filtered)
+    # YYYY-MM-DD strings compare in date order; entries without a date ("") are dropped
+    cutoff_str = cutoff_date.isoformat()
+    new_list_filtered: List[Dict[str, Any]] = [e for e in new_list if e.get("date", "") >= cutoff_str]
 
     existing = load_existing()
+    # 只把新条目或内容有变化（标题、摘要、分类等被修订）的条目追加到 history；
+    # 加载时后出现的同 id 行覆盖先前的，重复行由压缩清理
+    stored = {e['id']: e for e in existing if e.get('id')}
+    fresh = [e for e in new_list_filtered if content_changed(stored.get(e['id']), e)]
     merged = merge_and_dedupe(existing, new_list_filtered)
+    if not os.path.exists(HISTORY_FILE) or len(existing) + len(fresh) > COMPACT_THRESHOLD:
+        compact_history(merged)
+    else:
+        append_history(fresh)
     save_entries(merged)
+    # 数据落盘之后再更新校验头，避免中途失败时下次因 304 漏掉本次结果
+    # 只保留本次请求的校验头，过期日期条件的旧条目随之清理
+    save_cache({k: cache[k] for k in (cache_key(q, n) for q, n in requests_this_run) if k in cache})
 
-    print(f"Found {len(new_list)} unique results this run; {len(new_list_filtered)} are from the last {DAYS_TO_KEEP} days (since {cutoff_date.isoformat()}).")
+    print(f"Found {len(new_list)} unique results this run; {len(new_list_filtered)} are from the last {DAYS_TO_KEEP} days (since {cutoff_date.isoformat()}); {len(fresh)} are new or updated.")
     print(f"Saved {len(merged)} total entries to {OUTPUT_FILE}")
 
 if __name__ == "__main__":